@@ -1,22 +1,46 @@
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import os
+import sys
+import hashlib
+import base64
+import binascii
+import struct
+import heapq
+import pickle
+import mmap
+import sqlite3
+import orjson
 import asyncio
-import pandas as pd
 import time
-from collections import defaultdict
-from typing import Dict, List, Set
-from functools import lru_cache
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime, timezone
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
+    AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler,
     ContextTypes, filters, CallbackQueryHandler
 )
-from flask import Flask, request, jsonify
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+from openpyxl import load_workbook
+
+# calamine(Rust実装)の方がopenpyxlより高速。未インストール環境ではopenpyxlにフォールバック
+try:
+    from python_calamine import CalamineWorkbook
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 class Settings(BaseSettings):
     BOT_TOKEN: str
@@ -25,8 +49,13 @@ class Settings(BaseSettings):
     EXCEL_FILE_PATH: str = Field(default="rep.xlsx")
     MAX_REQUESTS_PER_MINUTE: int = Field(default=30)
     CACHE_TTL: int = Field(default=300)
+    MAX_WELCOMED_USERS: int = Field(default=100_000)
+    WELCOMED_TTL: int = Field(default=24 * 60 * 60)
     WEBHOOK_PATH: str = Field(default="/webhook_telegram")
     DEBUG: bool = Field(default=False)
+    EXCEL_CACHE: bool = Field(default=True)
+    EXCEL_CACHE_DIR: str = Field(default=".cache")
+    STATE_DB_PATH: str = Field(default="state.db")
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -34,6 +63,28 @@ class Settings(BaseSettings):
 settings = Settings()
 CHANNEL_ID = -1002647531334
 ADMIN_ID = 8149389037
+KICK_DELAY_SECONDS = 30 * 60
+INIT_ATTEMPTS = 5
+MAX_CONCURRENT_UPDATES = 256
+# チャンネル通知はこの秒数・件数まで溜めてから1通にまとめて送る
+NOTIFY_WINDOW_SECONDS = 1.0
+NOTIFY_BATCH_SIZE = 20
+# Telegramの1メッセージの文字数上限。まとめた通知がこれを超えないようにする
+MESSAGE_MAX_LENGTH = 4096
+# 終了時、キューに残った通知を送り切るまで待つ上限
+NOTIFY_FLUSH_TIMEOUT = 10.0
+# ハンドラが処理する更新の種類。これ以外は受け取らず、届いてもUpdateを組み立てない
+HANDLED_UPDATES = ("message", "callback_query")
+COLUMNS = ["Key", "Rep1", "Rep2", "Rep3"]
+# 列ごとの値を並べたタプル(Key, Rep1, Rep2, Rep3)。行ごとのdictは作らない
+Columns = Tuple[Tuple[str, ...], ...]
+# callback_dataの階層。struct.packの先頭1バイトに入る
+LEVEL_KEY, LEVEL_REP1, LEVEL_REP2 = 1, 2, 3
+# level(1バイト) + 採番の世代(2バイト) + ID×3(各2バイト、0xFFFE以下)。未使用のIDはNO_ID
+CALLBACK_FORMAT = struct.Struct("<BHHHH")
+NO_ID = 0xFFFF
+# pickleキャッシュの形式を変えたら上げる
+CACHE_VERSION = 2
 
 MESSAGES = {
     "welcome": "三上はじめにへようこそ。下記の選択肢からご希望の項目をお選びください。\n\n※ボタンを押した後、処理に数秒かかる場合がございます。しばらくお待ちいただくか、反応がない場合は再度ボタンを押してください。ご協力ありがとうございます。",
@@ -47,17 +98,40 @@ MESSAGES = {
     "error": "エラーが発生しました。お手数ですが、もう一度お試しください。",
     "number": "お客様の番号：{}"
 }
+# parse_mode='HTML'で送る文字列に埋め込む値のエスケープ表。translateで1回の走査で済ませる
+HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# 最終階層で毎回送る案内文は固定なので、連結は起動時に一度だけ行う
+FINAL_INSTRUCTION = f"{MESSAGES['instruction']}\n\n{MESSAGES['wait_time']}"
 
 class State:
     def __init__(self):
-        self.data: List[dict] = []
+        # 文字列 -> ID。IDは0からの連番なので、次のIDは登録済みの件数になる
         self.string_ids: Dict[str, int] = {}
-        self.id_strings: Dict[int, str] = {}
-        self.next_id = 0
-        self.welcomed_users: Set[int] = set()
+        # 採番の世代。最初の読み込み(と採番し直し)でデータの内容から決まる。
+        # 同じデータなら再起動しても同じIDと世代になり、送信済みのボタンがそのまま使える
+        self.id_epoch = 0
+        # 上限・有効期限付きLRU (user_id -> 最終/start時刻(monotonic))。古いユーザーから追い出す
+        self.welcomed_users: "OrderedDict[int, float]" = OrderedDict()
         self.last_refresh = 0
+        # 最後に読み込んだExcelの(mtime, size)
+        self.data_signature: Optional[Tuple[int, int]] = None
         self._requests = defaultdict(list)
-        self.processing = {}
+        # 処理中のユーザー。処理が終われば取り除くので、同時に処理中の人数分しか保持しない
+        self.processing: "set[int]" = set()
+        # 各メニューのキーボードはデータ更新時に一度だけ組み立て、全ユーザーで共有する
+        self.initial_markup: Optional[InlineKeyboardMarkup] = None
+        # 次の階層のメニューは (案内文, キーボード) の組で持ち、押下ごとの文字列整形をなくす
+        self.rep1_markups: Dict[int, Tuple[str, InlineKeyboardMarkup]] = {}
+        self.rep2_markups: Dict[Tuple[int, int], Tuple[str, InlineKeyboardMarkup]] = {}
+        # (key_id, rep1_id, rep2_id) -> (HTMLエスケープ済みのRep3, 番号の表示文)
+        self.finals: Dict[Tuple[int, int, int], Tuple[str, str]] = {}
+        # 自動退出の予定 (期限(monotonic), user_id)。1つのワーカーが期限順に処理する
+        self.kick_heap: List[Tuple[float, int]] = []
+        self.kick_wakeup = asyncio.Event()
+        # チャンネルへの通知文。notify_workerがまとめて送信する。Noneは終了の合図
+        self.notify_queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        # 自動退出の予定への書き込み (SQL, 引数)。kick_db_writerがスレッドでまとめて実行する。Noneは終了の合図
+        self.kick_db_queue: "asyncio.Queue[Optional[Tuple[str, tuple]]]" = asyncio.Queue()
 
     def can_request(self, user_id: int) -> bool:
         now = time.time()
@@ -66,42 +140,197 @@ class State:
         req.append(now)
         return True
 
-    def get_id(self, s: str) -> int:
-        if not s: return -1
-        if s not in self.string_ids:
-            self.string_ids[s] = self.next_id
-            self.id_strings[self.next_id] = s
-            self.next_id += 1
-        return self.string_ids[s]
+    def mark_welcomed(self, user_id: int):
+        self.welcomed_users[user_id] = time.monotonic()
+        self.welcomed_users.move_to_end(user_id)
+        if len(self.welcomed_users) > settings.MAX_WELCOMED_USERS:
+            self.welcomed_users.popitem(last=False)
+        self.expire_welcomed()
+
+    def expire_welcomed(self):
+        # 先頭ほど古いので、期限内の要素に当たった時点で打ち切れる
+        users = self.welcomed_users
+        limit = time.monotonic() - settings.WELCOMED_TTL
+        while users and next(iter(users.values())) < limit:
+            users.popitem(last=False)
 
-    def get_string(self, i: int) -> str:
-        return self.id_strings.get(i, '')
 
 state = State()
 logger = logging.getLogger(__name__)
-flask_app = Flask(__name__)
 application = None
+log_listener = None
+# 自動退出の予定を再起動後も失わないよう保存するSQLite。run_applicationで開く
+state_db: Optional[sqlite3.Connection] = None
+background_tasks = set()
+notify_task: Optional[asyncio.Task] = None
+kick_db_task: Optional[asyncio.Task] = None
+
+def read_cache(path: str):
+    try:
+        # mmapで読み込み、ファイル全体をバッファへコピーせずにunpickleする
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pickle.loads(mm)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Cache read error: %s", e)
+        return None
+
+def write_cache(path: str, data: Columns):
+    # 一時ファイルに書いてからos.replaceで差し替え、読み込み途中の不完全なファイルを避ける
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning("Cache write error: %s", e)
+
+def cell_text(v) -> str:
+    if v is None: return ''
+    # calamineは数値セルをfloatで返すため、整数値は"1.0"ではなく"1"にそろえる
+    if isinstance(v, float) and v.is_integer(): v = int(v)
+    return sys.intern(str(v))
+
+def read_excel_columns(path: str) -> Columns:
+    # 4列の参照表を読むだけなのでpandasは使わず、先頭シートの行を直接読む
+    wb = None
+    if EXCEL_ENGINE == "calamine":
+        rows = CalamineWorkbook.from_path(path).get_sheet_by_index(0).iter_rows()
+    else:
+        wb = load_workbook(path, read_only=True, data_only=True)
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+    try:
+        header = [str(h).strip() if h is not None else '' for h in next(rows, ())]
+        missing = [c for c in COLUMNS if c not in header]
+        if missing: raise ValueError(f"Missing columns: {missing}")
+        idx = [header.index(c) for c in COLUMNS]
+        # 行を1行ずつ読みながら列に振り分ける。シート全体や行のリストは保持しない
+        # 同じKey/Rep1が多数の行に現れるため、セル文字列をinternして重複オブジェクトをまとめる
+        columns = tuple([] for _ in COLUMNS)
+        for r in rows:
+            n = len(r)
+            for col, i in zip(columns, idx):
+                col.append(cell_text(r[i]) if i < n else '')
+        return tuple(map(tuple, columns)) if columns[0] else ()
+    finally:
+        if wb: wb.close()
 
 @lru_cache(maxsize=1)
-def load_excel_data() -> List[dict]:
+def load_excel_data() -> Columns:
     try:
-        df = pd.read_excel(settings.EXCEL_FILE_PATH, engine='openpyxl', na_values=[''])
-        df = df.fillna('')
-        return df.astype(str).to_dict(orient='records')
+        # Excelの解析結果をファイル内容のハッシュをキーにpickleで保存し、再起動時の再解析を省く
+        cache_path = None
+        if settings.EXCEL_CACHE:
+            with open(settings.EXCEL_FILE_PATH, 'rb') as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+            cache_path = os.path.join(settings.EXCEL_CACHE_DIR, f"{digest}.v{CACHE_VERSION}.pkl")
+            if (data := read_cache(cache_path)) is not None:
+                return data
+        data = read_excel_columns(settings.EXCEL_FILE_PATH)
+        if cache_path: write_cache(cache_path, data)
+        return data
     except Exception as e:
-        logger.error(f"Excel loading error: {e}")
-        return []
+        logger.error("Excel loading error: %s", e)
+        return ()
 
 def refresh_data():
     now = time.time()
     if now - state.last_refresh > settings.CACHE_TTL:
+        # ファイルが更新されていなければ、ハッシュ計算・読み込み・インデックス再構築をすべて省く
+        try:
+            st = os.stat(settings.EXCEL_FILE_PATH)
+            signature = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            signature = None
+        if signature and signature == state.data_signature:
+            state.last_refresh = now
+            return
         load_excel_data.cache_clear()
-        if data := load_excel_data():
-            state.data = data
+        if columns := load_excel_data():
             state.last_refresh = now
-            for row in data:
-                for field in ["Key", "Rep1", "Rep2"]:
-                    if row[field]: state.get_id(row[field])
+            try:
+                index_data(columns)
+            except OverflowError:
+                # 編集のたびに新しい文字列へIDを振るため、長く動かすと上限に達しうる。その時は採番し直す
+                logger.warning("String IDs exhausted, renumbering")
+                try:
+                    index_data(columns, renumber=True)
+                except OverflowError as e:
+                    # シート自体が大きすぎる。stateは変わっていないので以前のメニューを使い続け、CACHE_TTL後に再試行する
+                    logger.error("Failed to index data: %s", e)
+                    return
+            state.data_signature = signature
+
+def selected_text(s: str) -> str:
+    return f"{MESSAGES['selected'].format(s)}\n{MESSAGES['next_step']}"
+
+def assign_id(string_ids: Dict[str, int], s: str) -> int:
+    if not s: return -1
+    # 既存文字列(大半のケース)はdict.getの1回の探索で済ませる
+    i = string_ids.get(s)
+    if i is None:
+        # IDはcallback_dataに2バイトで入るため、NO_IDの手前までしか振れない
+        if len(string_ids) >= NO_ID:
+            raise OverflowError(f"More than {NO_ID} distinct strings")
+        i = string_ids[sys.intern(s)] = len(string_ids)
+    return i
+
+def numbering_epoch(rows) -> int:
+    h = hashlib.blake2b(digest_size=2)
+    for row in rows:
+        h.update("\x1f".join(row[:3]).encode())
+        h.update(b"\x1e")
+    return int.from_bytes(h.digest(), "little")
+
+def index_data(columns: Columns, renumber: bool = False):
+    # 行を(Key, Rep1, Rep2)の文字列順に一度だけ並べ、groupbyで1回走査して
+    # 文字列IDの採番・ボタン生成・階層ごとのキーボード構築をまとめて行う。
+    # 並べ替えは安定なので、同じ組が複数行あれば最初の行のRep3を採用する
+    rows = sorted((row for row in zip(*columns) if row[0]), key=itemgetter(0, 1, 2))
+    # 採番は写しの上で行い、すべて組み立てられた時だけstateへ反映する。
+    # 途中で失敗しても、以前のメニューとそのIDはそのまま使える
+    if renumber or not state.string_ids:
+        # 空から採番するIDは並べた行だけで決まるので、世代もその内容から求める
+        string_ids, epoch = {}, numbering_epoch(rows)
+        if renumber and epoch == state.id_epoch:
+            epoch = (epoch + 1) & 0xFFFF
+    else:
+        string_ids, epoch = dict(state.string_ids), state.id_epoch
+    get_id = partial(assign_id, string_ids)
+    encode = partial(encode_callback, epoch=epoch)
+    key_buttons = []
+    rep1_markups = {}
+    rep2_markups = {}
+    finals = {}
+    for key, key_rows in groupby(rows, itemgetter(0)):
+        key_id = get_id(key)
+        key_buttons.append([InlineKeyboardButton(key, callback_data=encode(LEVEL_KEY, key_id))])
+        rep1_buttons = []
+        for rep1, rep1_rows in groupby(key_rows, itemgetter(1)):
+            if not rep1: continue
+            rep1_id = get_id(rep1)
+            rep1_buttons.append([InlineKeyboardButton(rep1, callback_data=encode(LEVEL_REP1, key_id, rep1_id))])
+            rep2_buttons = []
+            for rep2, rep2_rows in groupby(rep1_rows, itemgetter(2)):
+                if not rep2: continue
+                # 最終階層のボタンは3つのIDを持ち、押下時に現在のデータから番号を引く。
+                # 古いキーボードや再起動後の押下で、別の組の番号を返さないようにするため
+                rep2_id = get_id(rep2)
+                rep3 = next(rep2_rows)[3]
+                rep2_buttons.append([InlineKeyboardButton(rep2, callback_data=encode(LEVEL_REP2, key_id, rep1_id, rep2_id))])
+                finals[key_id, rep1_id, rep2_id] = (rep3.translate(HTML_ESCAPE), MESSAGES["number"].format(rep3))
+            if rep2_buttons:
+                rep2_markups[key_id, rep1_id] = (selected_text(rep1), InlineKeyboardMarkup(rep2_buttons))
+        if rep1_buttons:
+            rep1_markups[key_id] = (selected_text(key), InlineKeyboardMarkup(rep1_buttons))
+    state.string_ids = string_ids
+    state.id_epoch = epoch
+    state.initial_markup = InlineKeyboardMarkup(key_buttons) if key_buttons else None
+    state.rep1_markups = rep1_markups
+    state.rep2_markups = rep2_markups
+    state.finals = finals
 
 def get_display_name(user):
     if getattr(user, 'full_name', None) and user.full_name.strip():
@@ -113,23 +342,200 @@ def get_display_name(user):
 def get_tag(user):
     return f"@{user.username}" if user.username else f"<a href='tg://user?id={user.id}'>user</a>"
 
+def encode_callback(level: int, key_id: int, rep1_id: int = -1, rep2_id: int = -1, *, epoch: int) -> str:
+    # 9バイトをURL安全なbase64の12文字にする(上限64バイト)
+    ids = (i if i >= 0 else NO_ID for i in (key_id, rep1_id, rep2_id))
+    return base64.urlsafe_b64encode(CALLBACK_FORMAT.pack(level, epoch, *ids)).rstrip(b"=").decode()
+
+def decode_callback(data: str) -> Tuple[int, int, int, int]:
+    # 不正・旧形式のデータや、別の世代(採番し直す前・別のデータで動いていた前のプロセス)のIDはlevel=0として扱う
+    try:
+        level, epoch, *ids = CALLBACK_FORMAT.unpack(base64.urlsafe_b64decode(data + "=="))
+    except (binascii.Error, struct.error, ValueError):
+        return 0, -1, -1, -1
+    if epoch != state.id_epoch:
+        return 0, -1, -1, -1
+    return (level, *(i if i != NO_ID else -1 for i in ids))
+
 async def safe_send(func, *args, **kwargs):
     try:
         return await func(*args, **kwargs)
     except Exception as e:
-        logger.warning(f"Send error: {e}")
+        logger.warning("Send error: %s", e)
+
+def run_in_background(coro):
+    # タスクへの参照を保持し、完了前にGCされないようにする
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def finalize_selection(user_id: int, msg: str):
+    # メッセージ例: 山田太郎 (@yamada) - 12345
+    state.notify_queue.put_nowait(msg)
+    # 30分後に自動で退出（管理者以外）
+    if user_id != ADMIN_ID:
+        schedule_kick(user_id)
+
+def schedule_kick(user_id: int):
+    heapq.heappush(state.kick_heap, (time.monotonic() + KICK_DELAY_SECONDS, user_id))
+    state.kick_wakeup.set()
+    # ヒープの期限はmonotonicなので、保存には再起動をまたいで使える時刻を使う
+    persist_kicks("INSERT OR REPLACE INTO kicks VALUES (?, ?)", (user_id, time.time() + KICK_DELAY_SECONDS))
+
+def persist_kicks(sql: str, params: tuple):
+    # イベントループ上ではキューに積むだけにし、ディスクへの書き込みはkick_db_writerに任せる
+    if state_db: state.kick_db_queue.put_nowait((sql, params))
+
+def write_kicks(db: sqlite3.Connection, ops: List[Tuple[str, tuple]]):
+    # スレッドで実行する。溜まった分を1トランザクションにまとめ、保存の失敗で退出処理を止めない
+    try:
+        db.execute("BEGIN")
+        for sql, params in ops:
+            db.execute(sql, params)
+        db.execute("COMMIT")
+    except sqlite3.Error as e:
+        logger.warning("Kick persistence error: %s", e)
+        if db.in_transaction: db.execute("ROLLBACK")
+
+async def kick_db_writer(db: sqlite3.Connection):
+    # 接続を使うのはこのタスクだけなので、スレッドをまたいでも同時に触られることはない
+    q = state.kick_db_queue
+    while True:
+        ops = [await q.get()]
+        while not q.empty():
+            ops.append(q.get_nowait())
+        stopping = None in ops
+        if ops := [op for op in ops if op]:
+            await asyncio.to_thread(write_kicks, db, ops)
+        if stopping: return
+
+async def stop_kick_db_writer():
+    # 終了の合図を積み、それまでの書き込みを済ませてから接続を閉じる
+    global kick_db_task, state_db
+    task, kick_db_task = kick_db_task, None
+    db, state_db = state_db, None
+    if task and not task.done():
+        state.kick_db_queue.put_nowait(None)
+        await task
+    if db: await asyncio.to_thread(db.close)
+
+def open_state_db() -> sqlite3.Connection:
+    # 書き込みはkick_db_writerがスレッドで行うため、作成したスレッド以外からの利用を許可する
+    db = sqlite3.connect(settings.STATE_DB_PATH, isolation_level=None, check_same_thread=False)
+    # WAL+NORMALでコミットごとのfsyncをなくす(電源断時に直近の予約を失いうるが、DBは壊れない)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS kicks (user_id INTEGER PRIMARY KEY, due REAL NOT NULL)")
+    return db
+
+def load_kicks(db: sqlite3.Connection) -> List[Tuple[int, float]]:
+    return db.execute("SELECT user_id, due FROM kicks").fetchall()
+
+def restore_kicks(rows: List[Tuple[int, float]]):
+    # 再起動前に予約された退出をヒープへ戻す。期限を過ぎた分はワーカー起動直後に処理される
+    offset = time.monotonic() - time.time()
+    for user_id, due in rows:
+        heapq.heappush(state.kick_heap, (due + offset, user_id))
+    logger.info("Restored %s pending kicks", len(state.kick_heap))
+
+async def kick_user(bot, user_id: int):
+    try:
+        # only_if_banned=False(既定)のunbanはメンバーをチャンネルから外し、再参加は許可したままにする
+        # ban+unbanの2回の呼び出しを1回にまとめられる
+        await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+    except Exception as e:
+        logger.error("Kick user error: %s", e)
+
+async def kick_worker(bot):
+    # ユーザーごとに30分眠るタスクを作らず、直近の期限まで待つ単一のタスクで処理する
+    heap, wakeup = state.kick_heap, state.kick_wakeup
+    while True:
+        delay = heap[0][0] - time.monotonic() if heap else None
+        if delay is None or delay > 0:
+            # 新しい予定が追加されたら起きて、最も早い期限を見直す
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+        _, user_id = heapq.heappop(heap)
+        await kick_user(bot, user_id)
+        # 退出後に予約し直された分(期限が未来)は残す
+        persist_kicks("DELETE FROM kicks WHERE user_id = ? AND due <= ?", (user_id, time.time()))
+
+async def notify_worker(bot):
+    # 同時に完了した複数ユーザーの通知を1通にまとめ、グループへの送信回数制限に掛かりにくくする
+    # 終了の合図(None)を受けたら、手元の分を待たずに送って終わる
+    # 文字数上限を超える分は次のまとまりへ持ち越す
+    q = state.notify_queue
+    loop = asyncio.get_running_loop()
+    stopping = False
+    carry = None
+    while not stopping:
+        msg = carry if carry is not None else await q.get()
+        carry = None
+        if msg is None: return
+        batch = [msg]
+        length = len(msg)
+        deadline = loop.time() + NOTIFY_WINDOW_SECONDS
+        while len(batch) < NOTIFY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try:
+                msg = await asyncio.wait_for(q.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if msg is None:
+                stopping = True
+                break
+            if length + 1 + len(msg) > MESSAGE_MAX_LENGTH:
+                carry = msg
+                break
+            batch.append(msg)
+            length += 1 + len(msg)
+        await send_notifications(bot, batch)
+
+async def send_notifications(bot, batch: List[str]):
+    if await safe_send(bot.send_message, chat_id=CHANNEL_ID, text="\n".join(batch), parse_mode='HTML'):
+        return
+    # まとめた送信に失敗したら1件ずつ送り直し、1件の不備で他の通知まで失わないようにする
+    if len(batch) > 1:
+        for msg in batch:
+            await safe_send(bot.send_message, chat_id=CHANNEL_ID, text=msg, parse_mode='HTML')
+
+async def stop_notify_worker():
+    # キューの末尾に終了の合図を積み、それまでの通知を送り切らせる
+    global notify_task
+    task, notify_task = notify_task, None
+    if not task or task.done(): return
+    state.notify_queue.put_nowait(None)
+    try:
+        await asyncio.wait_for(task, NOTIFY_FLUSH_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Dropped %s queued notifications on shutdown", state.notify_queue.qsize())
+
+async def load_data_worker():
+    # 起動時の読み込みに失敗しても、読み込めるまで間隔を広げながら再試行する。以降の更新はCACHE_TTLごとに行う
+    delay = 1
+    while True:
+        refresh_data()
+        if state.initial_markup: return
+        logger.warning("Data not loaded, retrying in %s seconds", delay)
+        await asyncio.sleep(delay)
+        state.last_refresh = 0
+        delay = min(delay * 2, settings.CACHE_TTL)
 
-async def send_initial_buttons(update: Update):
+async def send_initial_buttons(message):
     refresh_data()
-    if not state.data:
-        await safe_send(update.message.reply_text, MESSAGES["no_data"])
+    if not state.initial_markup:
+        await safe_send(message.reply_text, MESSAGES["no_data"])
         return
-    keys = sorted({row["Key"] for row in state.data if row["Key"]})
-    keyboard = [[InlineKeyboardButton(k, callback_data=f"key:{state.get_id(k)}::")] for k in keys]
     await safe_send(
-        update.message.reply_text,
+        message.reply_text,
         MESSAGES["welcome"],
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=state.initial_markup,
         parse_mode='Markdown'
     )
 
@@ -138,9 +544,9 @@ async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not state.can_request(user_id):
         await safe_send(update.message.reply_text, MESSAGES["rate_limit"])
         return
-    state.welcomed_users.discard(user_id)
-    await send_initial_buttons(update)
-    state.welcomed_users.add(user_id)
+    state.welcomed_users.pop(user_id, None)
+    await send_initial_buttons(update.message)
+    state.mark_welcomed(user_id)
 
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -148,128 +554,188 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     display_name = get_display_name(user)
     tag = get_tag(user)
-    if not state.can_request(user_id) or state.processing.get(user_id):
+    if not state.can_request(user_id) or user_id in state.processing:
         await safe_send(query.answer, MESSAGES["processing"])
         return
+    answered = None
     try:
-        state.processing[user_id] = True
-        await safe_send(query.answer)
+        state.processing.add(user_id)
+        # answerは後続の編集・送信と依存関係がないため、待たずに並行して送る
+        answered = asyncio.create_task(safe_send(query.answer))
         refresh_data()
-        level, *ids = query.data.split(':')
-        ids = [int(i) if i else -1 for i in ids]
-        key_id, rep1_id, rep2_id = ids + [-1] * (3 - len(ids))
-        key = state.get_string(key_id)
-        rep1 = state.get_string(rep1_id) if rep1_id != -1 else ''
-        rep2 = state.get_string(rep2_id) if rep2_id != -1 else ''
-        if level == "key":
-            rep1s = sorted({row["Rep1"] for row in state.data if row["Key"] == key and row["Rep1"]})
-            if rep1s:
-                keyboard = [[InlineKeyboardButton(r1, callback_data=f"rep1:{key_id}:{state.get_id(r1)}:")] for r1 in rep1s]
-                await safe_send(query.edit_message_text, f"{MESSAGES['selected'].format(key)}\n{MESSAGES['next_step']}", reply_markup=InlineKeyboardMarkup(keyboard))
-        elif level == "rep1":
-            rep2s = sorted({row["Rep2"] for row in state.data if row["Key"] == key and row["Rep1"] == rep1 and row["Rep2"]})
-            if rep2s:
-                keyboard = [[InlineKeyboardButton(r2, callback_data=f"rep2:{key_id}:{rep1_id}:{state.get_id(r2)}")] for r2 in rep2s]
-                await safe_send(query.edit_message_text, f"{MESSAGES['selected'].format(rep1)}\n{MESSAGES['next_step']}", reply_markup=InlineKeyboardMarkup(keyboard))
-        elif level == "rep2":
-            rep3 = next((row["Rep3"] for row in state.data if row["Key"] == key and row["Rep1"] == rep1 and row["Rep2"] == rep2), MESSAGES["no_data"])
-            await safe_send(query.edit_message_text, MESSAGES["number"].format(rep3))
-
-            # メッセージ例: 山田太郎 (@yamada) - 12345
-            msg = f"{display_name}（{tag}） - {rep3}"
-            await safe_send(context.bot.send_message, chat_id=CHANNEL_ID, text=msg, parse_mode='HTML')
-            
-            # 30分後に自動で退出（管理者以外）
-            if user_id != ADMIN_ID:
-                async def delayed_kick():
-                    await asyncio.sleep(30 * 60)
-                    try:
-                        await context.bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                        await context.bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                    except Exception as e:
-                        logger.error(f"Kick user error: {e}")
-                asyncio.create_task(delayed_kick())
-            await safe_send(query.message.reply_text, f"{MESSAGES['instruction']}\n\n{MESSAGES['wait_time']}", parse_mode='HTML')
+        level, key_id, rep1_id, rep2_id = decode_callback(query.data)
+        if level == LEVEL_KEY:
+            menu = state.rep1_markups.get(key_id)
+        elif level == LEVEL_REP1:
+            menu = state.rep2_markups.get((key_id, rep1_id))
+        elif level == LEVEL_REP2:
+            menu = state.finals.get((key_id, rep1_id, rep2_id))
+        else:
+            menu = None
+        if not menu:
+            # 古いボタン(データの更新で無くなった組・別の世代)。通知も自動退出も行わず、最初のメニューを送り直す
+            await send_initial_buttons(query.message)
+        elif level != LEVEL_REP2:
+            await safe_send(query.edit_message_text, menu[0], reply_markup=menu[1])
+        else:
+            rep3, number_text = menu
+            # チャンネル通知と自動退出はキューに積むだけにして、ユーザーへの応答を待たせない
+            finalize_selection(user_id, f"{display_name.translate(HTML_ESCAPE)}（{tag}） - {rep3}")
+            # 番号の表示と案内メッセージは互いに依存しないため並行して送る
+            await asyncio.gather(
+                safe_send(query.edit_message_text, number_text),
+                safe_send(query.message.reply_text, FINAL_INSTRUCTION, parse_mode='HTML'),
+            )
     except Exception as e:
-        logger.error(f"Button handler error: {e}")
+        logger.error("Button handler error: %s", e)
         await safe_send(query.message.reply_text, MESSAGES["error"])
     finally:
-        state.processing[user_id] = False
-
-def run_async(coro):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(coro)
-    finally:
-        loop.close()
+        if answered: await answered
+        state.processing.discard(user_id)
 
-@flask_app.route(settings.WEBHOOK_PATH, methods=["POST"])
-def webhook_handler():
-    if not application: return "Bot not ready", 503
+async def webhook_handler(request: Request):
+    if not application: return PlainTextResponse("Bot not ready", status_code=503)
     try:
-        data = request.get_json(force=True)
-        if data:
-            run_async(process_update(data))
-        return "ok", 200
+        data = orjson.loads(await request.body())
+        if data and any(k in data for k in HANDLED_UPDATES):
+            await process_update(data)
+        return PlainTextResponse("ok")
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
-        return "ok", 200
+        logger.error("Webhook error: %s", e)
+        return PlainTextResponse("ok")
 
 async def process_update(update_dict: dict):
+    # PTB内部の更新キューに積むだけにし、処理の完了を待たずにWebhookへ応答する
     update = Update.de_json(update_dict, application.bot)
-    await application.process_update(update)
+    await application.update_queue.put(update)
 
-@flask_app.route("/health")
-def health_check():
-    return jsonify({
-        "status": "ok",
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "version": "1.0.0",
-        "active_users": len(state.welcomed_users)
-    })
+# 固定部分は起動時に一度だけシリアライズしておく
+_HEALTH_PREFIX = b'{"status":"ok","version":"1.0.0"'
+
+async def health_check(request: Request):
+    # 状態を読むだけにする。データ未読み込みの間は503を返し、再読み込みはload_data_worker等に任せる
+    if not state.initial_markup:
+        return Response(b'{"status":"loading"}', status_code=503, media_type="application/json")
+    state.expire_welcomed()
+    body = _HEALTH_PREFIX + f',"timestamp":"{datetime.now(timezone.utc).isoformat()}","active_users":{len(state.welcomed_users)}}}'.encode()
+    return Response(body, media_type="application/json")
+
+# Flask(WSGI)を経由せず、Hypercornから直接呼ばれる最小構成のASGIアプリ
+web_app = Starlette(routes=[
+    Route(settings.WEBHOOK_PATH, webhook_handler, methods=["POST"]),
+    Route("/health", health_check),
+])
+
+def setup_logging() -> QueueListener:
+    # ハンドラ側はキューに積むだけにし、実際の出力(I/O)はリスナースレッドで行う
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(logging.DEBUG if settings.DEBUG else logging.INFO)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+async def stop_application():
+    global application
+    # 先にapplicationを外し、webhookが新しい更新を受け付けないようにする
+    app, application = application, None
+    if not app: return
+    # 処理中の更新を終えてから、それらが積んだ通知を送り切り、最後にBotを閉じる
+    try:
+        if app.running: await app.stop()
+    except Exception as e:
+        logger.warning("Shutdown error: %s", e)
+    await stop_notify_worker()
+    try:
+        await app.shutdown()
+    except Exception as e:
+        logger.warning("Shutdown error: %s", e)
 
 async def init_application():
     global application
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.DEBUG if settings.DEBUG else logging.INFO
-    )
     try:
         application = (
             ApplicationBuilder()
             .token(settings.BOT_TOKEN)
-            .concurrent_updates(True)
+            .updater(None)
+            # 同時に処理する更新の上限。ハンドラはblock=Trueのまま登録し、処理中の更新がこの枠を占有するようにする
+            .concurrent_updates(MAX_CONCURRENT_UPDATES)
+            # Telegramの送信上限(全体30件/秒など)を超えないよう送信を平準化し、429時は再試行する
+            .rate_limiter(AIORateLimiter(max_retries=3))
+            # 同時に多数の送信が走っても接続の取得待ちで詰まらないよう、プールを広げHTTP/2で多重化する
+            .connection_pool_size(256)
+            .pool_timeout(5.0)
+            .connect_timeout(5.0)
+            .read_timeout(20.0)
+            .http_version("2")
             .build()
         )
+        # block=Falseにすると生成直後にconcurrent_updatesの枠が解放され、同時実行数が無制限になるため使わない
         application.add_handler(CommandHandler("start", handle_start))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: u.message.reply_text(MESSAGES["welcome"])))
         application.add_handler(CallbackQueryHandler(handle_button))
         await application.initialize()
-        await application.bot.set_webhook(url=f"{settings.WEBHOOK_URL}{settings.WEBHOOK_PATH}")
-        refresh_data()
+        # update_queueからの取り出しと各ハンドラへの振り分けはPTBに任せる
+        await application.start()
+        await application.bot.set_webhook(
+            url=f"{settings.WEBHOOK_URL}{settings.WEBHOOK_PATH}",
+            allowed_updates=list(HANDLED_UPDATES)
+        )
         return True
     except Exception as e:
-        logger.critical(f"Initialization error: {e}")
+        logger.critical("Initialization error: %s", e)
+        await stop_application()
         return False
 
 async def run_application():
+    global log_listener, state_db, notify_task, kick_db_task
+    log_listener = setup_logging()
     try:
-        if await init_application():
-            config = Config()
-            config.bind = [f"0.0.0.0:{settings.PORT}"]
-            await serve(flask_app, config)
+        # 一時的な障害で即終了して再起動を繰り返さないよう、指数バックオフで再試行する
+        for attempt in range(INIT_ATTEMPTS):
+            if attempt:
+                delay = 2 ** (attempt - 1)
+                logger.warning("Retrying initialization in %s seconds", delay)
+                await asyncio.sleep(delay)
+            if await init_application(): break
         else:
             raise RuntimeError("Application initialization failed")
+        try:
+            db = await asyncio.to_thread(open_state_db)
+            restore_kicks(await asyncio.to_thread(load_kicks, db))
+            state_db = db
+            kick_db_task = run_in_background(kick_db_writer(db))
+        except sqlite3.Error as e:
+            logger.warning("Kick persistence disabled: %s", e)
+        run_in_background(load_data_worker())
+        run_in_background(kick_worker(application.bot))
+        notify_task = run_in_background(notify_worker(application.bot))
+        config = Config()
+        config.bind = [f"0.0.0.0:{settings.PORT}"]
+        await serve(web_app, config)
     except Exception as e:
-        logger.critical(f"Startup error: {e}")
+        logger.critical("Startup error: %s", e)
         raise
+    finally:
+        await stop_application()
+        await stop_kick_db_writer()
 
 if __name__ == '__main__':
+    # uvloop(libuv実装)の方がタスク切り替え・ソケット処理が速い。未インストール環境では標準のループを使う
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(run_application())
     except KeyboardInterrupt:
         logger.info("Shutdown by user")
     except Exception as e:
-        logger.critical(f"Fatal error: {e}")
+        logger.critical("Fatal error: %s", e)
         raise
+    finally:
+        if log_listener: log_listener.stop()